@@ -0,0 +1,261 @@
+import re
+import unicodedata
+from typing import Dict, List, Optional
+
+from sqlalchemy import bindparam, event, insert, or_, update
+from sqlalchemy.orm import Session
+
+from ..models import models
+
+# ブロッキングキーの粒度
+COORDINATE_DECIMALS = 3   # 緯度経度の丸め桁数（約100m）
+
+# ブロック内で重複と判定する許容差
+RENT_TOLERANCE = 2000         # 家賃＋管理費の差（円）
+RENT_TOLERANCE_RATIO = 0.03   # 家賃＋管理費の差（割合）
+SIZE_TOLERANCE = 1.0          # 専有面積の差（㎡）
+
+_DASHES = re.compile(r"[‐‑‒–—―−－]|(?<=\d)ー(?=\d)")
+_BLOCK_NUMBERS = re.compile(r"(?<=\d)(丁目|番地|番|号)")
+_KANJI_BLOCK_NUMBERS = re.compile(r"([〇一二三四五六七八九十百千]+)(?=丁目|番地|番|号)")
+_KANJI_DIGITS = {"〇": 0, "一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+_KANJI_UNITS = {"十": 10, "百": 100, "千": 1000}
+
+
+def _kanji_to_number(kanji: str) -> int:
+    # 「十二」「二十」「百五」のような位取りと「二〇」のような並びの両方に対応する
+    if not any(char in _KANJI_UNITS for char in kanji):
+        return int("".join(str(_KANJI_DIGITS[char]) for char in kanji))
+    total, digit = 0, 0
+    for char in kanji:
+        if char in _KANJI_UNITS:
+            total += (digit or 1) * _KANJI_UNITS[char]
+            digit = 0
+        else:
+            digit = _KANJI_DIGITS[char]
+    return total + digit
+
+
+def normalize_address(address: str) -> str:
+    """
+    サイトごとの表記揺れを吸収するために住所を正規化する。
+    例: 「東京都新宿区西新宿 一丁目2番3号」→「東京都新宿区西新宿1-2-3」
+    """
+    address = unicodedata.normalize("NFKC", address)
+    address = re.sub(r"\s+", "", address)
+    address = _KANJI_BLOCK_NUMBERS.sub(lambda match: str(_kanji_to_number(match.group(1))), address)
+    address = _DASHES.sub("-", address)
+    address = _BLOCK_NUMBERS.sub("-", address)
+    return address.rstrip("-").lower()
+
+
+def normalize_name(name: str) -> str:
+    """
+    建物名の全角・半角や空白の違いを吸収するために正規化する。
+    """
+    name = unicodedata.normalize("NFKC", name)
+    return re.sub(r"\s+", "", name).lower()
+
+
+def _total_rent(property) -> int:
+    return property.rent + (property.management_fee or 0)
+
+
+def address_key(property) -> str:
+    return f"{normalize_address(property.address)}|{property.floor}"
+
+
+def geo_key(property) -> Optional[str]:
+    if property.latitude is None or property.longitude is None:
+        return None
+    # 家賃・面積は区切りの境界をまたぐ重複を取りこぼすためキーに含めず、
+    # is_duplicateで許容差を判定する
+    return "{lat:.{d}f},{lon:.{d}f}|{floor}".format(
+        lat=float(property.latitude),
+        lon=float(property.longitude),
+        d=COORDINATE_DECIMALS,
+        floor=property.floor,
+    )
+
+
+def is_duplicate(a, b) -> bool:
+    """
+    同じブロックに属する2件の物件が同一住戸かどうかを判定する。
+    座標のブロックには近隣の別の建物も含まれるため、
+    正規化した住所か建物名のいずれかが一致することも条件とする。
+    """
+    if a.floor != b.floor:
+        return False
+    if address_key(a) != address_key(b) and normalize_name(a.name) != normalize_name(b.name):
+        return False
+    if unicodedata.normalize("NFKC", a.floor_plan).upper() != unicodedata.normalize("NFKC", b.floor_plan).upper():
+        return False
+    rent_a, rent_b = _total_rent(a), _total_rent(b)
+    if abs(rent_a - rent_b) > max(RENT_TOLERANCE, RENT_TOLERANCE_RATIO * max(rent_a, rent_b)):
+        return False
+    return abs(a.size_sqm - b.size_sqm) <= SIZE_TOLERANCE
+
+
+def assign_blocking_keys(property: models.Property):
+    property.dedup_address_key = address_key(property)
+    property.dedup_geo_key = geo_key(property)
+
+
+def link_duplicate(db: Session, property: models.Property) -> Optional[int]:
+    """
+    登録前の物件について同じブロックの既存物件と比較し、
+    重複していれば元の物件のIDをduplicate_of_idに設定する。
+    """
+    assign_blocking_keys(property)
+
+    block_filters = [models.Property.dedup_address_key == property.dedup_address_key]
+    if property.dedup_geo_key is not None:
+        block_filters.append(models.Property.dedup_geo_key == property.dedup_geo_key)
+
+    candidates = db.query(models.Property).filter(
+        models.Property.duplicate_of_id.is_(None),
+        or_(*block_filters),
+    ).order_by(models.Property.id)
+
+    for candidate in candidates:
+        if candidate is not property and is_duplicate(property, candidate):
+            property.duplicate_of_id = candidate.id
+            return candidate.id
+    return None
+
+
+def dedup_signature(property) -> tuple:
+    """
+    重複判定に使う値の組。更新前後で比較し、再判定が必要かを判断する。
+    """
+    return (
+        address_key(property),
+        geo_key(property),
+        normalize_name(property.name),
+        _total_rent(property),
+        property.size_sqm,
+        unicodedata.normalize("NFKC", property.floor_plan).upper(),
+    )
+
+
+def relink_duplicate(db: Session, property: models.Property, previous_signature: tuple) -> Optional[int]:
+    """
+    更新された物件について、重複判定に使う値が変わっていれば重複の紐付けをやり直す。
+    """
+    if dedup_signature(property) == previous_signature:
+        return property.duplicate_of_id
+    property.duplicate_of_id = None
+    return link_duplicate(db, property)
+
+
+def unlink_duplicates(db: Session, property: models.Property):
+    """
+    削除する物件を元とする重複物件のうち最も古いものを新たな元物件に昇格させる。
+    昇格は/properties/changesにUPDATEとして記録されるが、削除された物件と
+    同一住戸のため/properties/streamでは新着として配信しない。
+    """
+    duplicates = db.query(models.Property).filter(
+        models.Property.duplicate_of_id == property.id
+    ).order_by(models.Property.id).all()
+    if not duplicates:
+        return
+
+    canonical = duplicates[0]
+    canonical.duplicate_of_id = None
+    for duplicate in duplicates[1:]:
+        duplicate.duplicate_of_id = canonical.id
+
+
+def backfill_duplicates(db: Session, batch_size: int = 5000) -> int:
+    """
+    既存の全物件についてブロッキングキーを計算し、重複を紐付け直す。
+    ブロック内のみを比較するため、件数に対してほぼ線形の時間で完了する。
+    重複と判定した件数を返す。
+    """
+    property = models.Property
+    rows = db.query(
+        property.id,
+        property.name,
+        property.address,
+        property.latitude,
+        property.longitude,
+        property.rent,
+        property.management_fee,
+        property.floor_plan,
+        property.size_sqm,
+        property.floor,
+        property.dedup_address_key,
+        property.dedup_geo_key,
+        property.duplicate_of_id,
+    ).order_by(property.id).all()
+
+    # ブロッキングキーごとの元物件（重複でない物件）
+    blocks: Dict[str, List] = {}
+    updates = []
+    changed_ids = set()
+    duplicate_count = 0
+
+    for row in rows:
+        keys = [key for key in (address_key(row), geo_key(row)) if key is not None]
+        duplicate_of_id = None
+        for key in keys:
+            for candidate in blocks.get(key, ()):
+                if is_duplicate(row, candidate):
+                    duplicate_of_id = candidate.id
+                    break
+            if duplicate_of_id is not None:
+                break
+
+        if duplicate_of_id is None:
+            for key in keys:
+                blocks.setdefault(key, []).append(row)
+        else:
+            duplicate_count += 1
+
+        # 値が変わった物件のみ更新する
+        values = {
+            "dedup_address_key": keys[0],
+            "dedup_geo_key": geo_key(row),
+            "duplicate_of_id": duplicate_of_id,
+        }
+        if any(getattr(row, key) != value for key, value in values.items()):
+            updates.append({"b_id": row.id, **values})
+            if row.duplicate_of_id != duplicate_of_id:
+                changed_ids.add(row.id)
+
+    # updated_atは変更せずにまとめて更新し、同じトランザクションで変更ログにも記録する。
+    # ブロッキングキーはAPIのレスポンスに含まれないため、紐付けが変わった物件のみ記録する
+    properties = property.__table__
+    statement = update(properties).where(properties.c.id == bindparam("b_id")).values(
+        updated_at=properties.c.updated_at
+    )
+    for start in range(0, len(updates), batch_size):
+        batch = updates[start:start + batch_size]
+        db.execute(statement, batch)
+        changes = [
+            {"property_id": values["b_id"], "operation": "UPDATE"}
+            for values in batch
+            if values["b_id"] in changed_ids
+        ]
+        if changes:
+            db.execute(insert(models.PropertyChange.__table__), changes)
+        db.commit()
+
+    return duplicate_count
+
+
+# 住所などが更新された場合もブロッキングキーを最新に保つ
+@event.listens_for(models.Property, "before_insert")
+@event.listens_for(models.Property, "before_update")
+def _property_before_write(mapper, connection, target):
+    assign_blocking_keys(target)
+
+
+if __name__ == "__main__":
+    from ..database.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        print(f"{backfill_duplicates(db)} duplicate properties linked")
+    finally:
+        db.close()
@@ -1,9 +1,13 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, DECIMAL, Boolean, func
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, DECIMAL, Boolean, Index, func, event, inspect
+from sqlalchemy.orm import relationship, object_session
 from ..database.database import Base
 
 class Property(Base):
     __tablename__ = "properties"
+    __table_args__ = (
+        # 一覧（重複掲載を除く）のおすすめ順をインデックスで返すための複合インデックス
+        Index("idx_duplicate_of_score", "duplicate_of_id", "score"),
+    )
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     name = Column(String(255), nullable=False)
@@ -26,13 +30,22 @@ class Property(Base):
     status = Column(String(20), nullable=False)
     site_url = Column(String(500), nullable=False)
     main_image_url = Column(String(500), nullable=True)
+    # おすすめ順（sort=score）のための集計値とスコア。書き込み時に再計算される
+    has_internet_plan = Column(Boolean, nullable=False, default=False)
+    nearest_bike_parking_distance = Column(Float, nullable=True)
+    score = Column(Float, nullable=True, index=True)
+    # 重複掲載の検出用。重複と判定された物件は元の物件のIDを持つ
+    dedup_address_key = Column(String(300), nullable=True, index=True)
+    dedup_geo_key = Column(String(100), nullable=True, index=True)
+    duplicate_of_id = Column(Integer, ForeignKey("properties.id", ondelete="SET NULL"), nullable=True, index=True)
     created_at = Column(DateTime, nullable=False, default=func.now())
     updated_at = Column(DateTime, nullable=False, default=func.now(), onupdate=func.now())
 
     # リレーションシップ
-    internet_provider = relationship("InternetProvider", back_populates="property", uselist=False)
-    bike_parkings = relationship("BikeParking", back_populates="property")
-    notifications = relationship("Notification", back_populates="property")
+    # 物件の削除時は関連情報も削除する
+    internet_provider = relationship("InternetProvider", back_populates="property", uselist=False, cascade="all, delete-orphan")
+    bike_parkings = relationship("BikeParking", back_populates="property", cascade="all, delete-orphan")
+    notifications = relationship("Notification", back_populates="property", cascade="all, delete-orphan")
 
 
 class InternetProvider(Base):
@@ -79,3 +92,59 @@ class Notification(Base):
 
     # リレーションシップ
     property = relationship("Property", back_populates="notifications")
+
+
+class PropertyChange(Base):
+    __tablename__ = "property_changes"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    # idは単調増加し、差分取得の継続トークンとして使用する
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    # 削除後もトゥームストーンとして残すため外部キーは張らない
+    property_id = Column(Integer, nullable=False, index=True)
+    operation = Column(String(10), nullable=False)
+    changed_at = Column(DateTime, nullable=False, default=func.now(), server_default=func.now())
+
+
+# 物件の書き込みを変更ログに記録する
+def _record_property_change(connection, property_id, operation):
+    connection.execute(
+        PropertyChange.__table__.insert().values(property_id=property_id, operation=operation)
+    )
+
+
+@event.listens_for(Property, "after_insert")
+def _property_after_insert(mapper, connection, target):
+    _record_property_change(connection, target.id, "INSERT")
+
+
+@event.listens_for(Property, "after_update")
+def _property_after_update(mapper, connection, target):
+    # 実際に値が変わっていない場合は記録しない
+    session = object_session(target)
+    if session is not None and not session.is_modified(target, include_collections=False):
+        return
+    _record_property_change(connection, target.id, "UPDATE")
+
+
+@event.listens_for(Property, "after_delete")
+def _property_after_delete(mapper, connection, target):
+    _record_property_change(connection, target.id, "DELETE")
+
+
+# 物件に含まれる関連情報の変更も物件のUPDATEとして記録する
+@event.listens_for(InternetProvider, "after_insert")
+@event.listens_for(InternetProvider, "after_update")
+@event.listens_for(InternetProvider, "after_delete")
+@event.listens_for(BikeParking, "after_insert")
+@event.listens_for(BikeParking, "after_update")
+@event.listens_for(BikeParking, "after_delete")
+@event.listens_for(Notification, "after_insert")
+@event.listens_for(Notification, "after_update")
+@event.listens_for(Notification, "after_delete")
+def _related_after_write(mapper, connection, target):
+    # 紐付け先の物件が変わった場合は変更前の物件も記録する
+    history = inspect(target).attrs.property_id.history
+    for property_id in set(history.deleted or []) | {target.property_id}:
+        if property_id is not None:
+            _record_property_change(connection, property_id, "UPDATE")
@@ -0,0 +1,172 @@
+import asyncio
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from ..models import models
+from ..schemas import schemas
+
+# 1クライアントあたりに保持する未送信イベントの上限
+SUBSCRIBER_BUFFER_SIZE = 100
+
+_PROPERTY_FIELDS = list(schemas.PropertyBase.__fields__.keys())
+
+
+class Subscription:
+    """
+    物件イベントの購読者。
+    未送信イベントは上限付きのバッファに保持し、溢れた場合は古いものから破棄します。
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        station: Optional[str] = None,
+        min_rent: Optional[int] = None,
+        max_rent: Optional[int] = None,
+        floor_plan: Optional[str] = None,
+        buffer_size: int = SUBSCRIBER_BUFFER_SIZE,
+    ):
+        self.loop = loop
+        self.station = station
+        self.min_rent = min_rent
+        self.max_rent = max_rent
+        self.floor_plan = floor_plan
+        self.buffer = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self._ready = asyncio.Event()
+
+    def matches(self, event: schemas.PropertyStreamEvent) -> bool:
+        # get_propertiesと同じ条件でフィルタリング
+        property = event.property
+        if self.station and property.station != self.station:
+            return False
+        if self.min_rent and property.rent < self.min_rent:
+            return False
+        if self.max_rent and property.rent > self.max_rent:
+            return False
+        if self.floor_plan and property.floor_plan != self.floor_plan:
+            return False
+        return True
+
+    def push(self, event: schemas.PropertyStreamEvent):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(event)
+        self._ready.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        イベントが届くまで待機する。タイムアウトした場合はFalseを返す。
+        """
+        if self.buffer or self.dropped:
+            return True
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def drain(self) -> List[schemas.PropertyStreamEvent]:
+        events = list(self.buffer)
+        self.buffer.clear()
+        self._ready.clear()
+        return events
+
+
+class PropertyBroker:
+    """
+    プロセス内の物件イベント配信（pub/sub）。
+    発行はスレッドプール上の同期ハンドラからも行えるよう、
+    購読者のイベントループごとにまとめて配送します。
+    """
+
+    def __init__(self):
+        self._subscriptions: Dict[asyncio.AbstractEventLoop, Set[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, **filters) -> Subscription:
+        subscription = Subscription(asyncio.get_running_loop(), **filters)
+        with self._lock:
+            self._subscriptions.setdefault(subscription.loop, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.loop)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.loop]
+
+    def subscription_count(self) -> int:
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def publish(self, event: schemas.PropertyStreamEvent):
+        with self._lock:
+            loops = list(self._subscriptions.keys())
+        for loop in loops:
+            try:
+                loop.call_soon_threadsafe(self._dispatch, loop, event)
+            except RuntimeError:
+                # イベントループが既に終了している
+                with self._lock:
+                    self._subscriptions.pop(loop, None)
+
+    def _dispatch(self, loop: asyncio.AbstractEventLoop, event: schemas.PropertyStreamEvent):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(loop, ()))
+        for subscription in subscriptions:
+            if subscription.matches(event):
+                subscription.push(event)
+
+
+broker = PropertyBroker()
+
+
+# 物件の書き込みからイベントを生成し、コミット後に配信する
+def _queue_property_event(target, event_type: str):
+    session = Session.object_session(target)
+    if session is None:
+        return
+    snapshot = {field: getattr(target, field) for field in _PROPERTY_FIELDS}
+    session.info.setdefault("property_events", []).append(
+        schemas.PropertyStreamEvent(
+            event=event_type,
+            property=schemas.PropertyStreamItem(id=target.id, **snapshot),
+        )
+    )
+
+
+@event.listens_for(models.Property, "after_insert")
+def _property_after_insert(mapper, connection, target):
+    # 重複掲載は一覧に表示されないため配信しない
+    if target.duplicate_of_id is None:
+        _queue_property_event(target, "CREATED")
+
+
+@event.listens_for(models.Property, "after_update")
+def _property_after_update(mapper, connection, target):
+    # 重複掲載は一覧に表示されないため配信しない。
+    # 重複掲載から元物件への昇格はduplicate_of_idのみの変更で、削除された
+    # 元物件と同一住戸のため配信しない（変更は/properties/changesに記録される）
+    if target.duplicate_of_id is not None:
+        return
+    if inspect(target).attrs.status.history.has_changes():
+        _queue_property_event(target, "STATUS_CHANGED")
+
+
+@event.listens_for(Session, "after_commit")
+def _session_after_commit(session):
+    for property_event in session.info.pop("property_events", []):
+        broker.publish(property_event)
+
+
+@event.listens_for(Session, "after_rollback")
+def _session_after_rollback(session):
+    session.info.pop("property_events", None)
@@ -1,13 +1,28 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from typing import List, Optional
+from datetime import timedelta
 from ..database.database import get_db
 from ..models import models
 from ..schemas import schemas
+from ..pubsub.property_broker import broker
+from ..scoring.property_score import score_expression
+from ..dedup.property_dedup import dedup_signature, link_duplicate, relink_duplicate, unlink_duplicates
 from geopy.distance import distance
 
 router = APIRouter()
 
+# SSE接続を維持するためのハートビート間隔（秒）
+STREAM_HEARTBEAT_SECONDS = 15
+
+# 差分フィードで配信を保留する期間（秒）。変更ログのIDはコミット順ではないため、
+# 直近の変更は先に採番された未コミットの変更を追い越している可能性がある
+CHANGE_FEED_SAFETY_SECONDS = 5
+# 差分フィードの1回のリクエストで走査する変更ログのID範囲
+CHANGE_FEED_SCAN_WINDOW = 10000
+
 @router.get("/properties/", response_model=List[schemas.Property])
 def get_properties(
     skip: int = 0, 
@@ -16,11 +31,24 @@ def get_properties(
     min_rent: Optional[int] = None,
     max_rent: Optional[int] = None,
     floor_plan: Optional[str] = None,
+    include_duplicates: bool = False,
+    sort: Optional[str] = None,
+    w_rent: Optional[float] = None,
+    w_walking_minutes: Optional[float] = None,
+    w_size_sqm: Optional[float] = None,
+    w_building_age: Optional[float] = None,
+    w_corner_room: Optional[float] = None,
+    w_internet_plan: Optional[float] = None,
+    w_bike_parking: Optional[float] = None,
     db: Session = Depends(get_db)
 ):
     """
     物件一覧を取得するエンドポイント。
     フィルタリングパラメータを指定可能。
+    重複掲載と判定された物件はinclude_duplicates=trueを指定した場合のみ含めます。
+    sort=scoreを指定するとおすすめスコアの高い順に並べ替えます。
+    w_で始まるパラメータでスコアの重みを変更できます（未指定の場合は
+    事前計算済みのスコア列のインデックスを使用します）。
     """
     query = db.query(models.Property)
     
@@ -33,12 +61,163 @@ def get_properties(
         query = query.filter(models.Property.rent <= max_rent)
     if floor_plan:
         query = query.filter(models.Property.floor_plan == floor_plan)
+    if not include_duplicates:
+        query = query.filter(models.Property.duplicate_of_id.is_(None))
     
+    # 並べ替え
+    if sort == "score":
+        weights = {
+            key: value
+            for key, value in {
+                "rent": w_rent,
+                "walking_minutes": w_walking_minutes,
+                "size_sqm": w_size_sqm,
+                "building_age": w_building_age,
+                "corner_room": w_corner_room,
+                "internet_plan": w_internet_plan,
+                "bike_parking": w_bike_parking,
+            }.items()
+            if value is not None
+        }
+        if weights:
+            query = query.order_by(score_expression(weights).desc(), models.Property.id.desc())
+        else:
+            # 同順位はIDの降順とし、並べ替えの方向をscoreのインデックスと揃える
+            query = query.order_by(models.Property.score.desc(), models.Property.id.desc())
+    elif sort is not None:
+        raise HTTPException(status_code=400, detail="Unsupported sort")
+
     # ページネーション
     properties = query.offset(skip).limit(limit).all()
     return properties
 
 
+@router.get("/properties/changes", response_model=schemas.PropertyChangeFeed)
+def get_property_changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db)
+):
+    """
+    指定トークン以降に追加・更新・削除された物件を取得するエンドポイント。
+    同一物件の複数回の変更は最新の1件にまとめて返します。
+    レスポンスのnext_tokenを次回のsinceに指定することで差分同期できます。
+    未コミットの変更を読み飛ばさないよう、直近数秒の変更は次回以降に返します。
+    """
+    change_log = models.PropertyChange
+    cutoff = db.query(func.now()).scalar() - timedelta(seconds=CHANGE_FEED_SAFETY_SECONDS)
+    scan_upper = since + CHANGE_FEED_SCAN_WINDOW
+    max_id = db.query(func.max(change_log.id)).scalar() or 0
+
+    # 走査範囲内で最初の直近の変更より前の、確定済みの変更までを対象にする
+    first_recent_id = db.query(func.min(change_log.id)).filter(
+        change_log.id > since, change_log.id <= scan_upper, change_log.changed_at > cutoff
+    ).scalar()
+    settled = db.query(func.max(change_log.id)).filter(
+        change_log.id > since, change_log.id <= scan_upper, change_log.changed_at <= cutoff
+    )
+    if first_recent_id is not None:
+        settled = settled.filter(change_log.id < first_recent_id)
+    upper = settled.scalar()
+    if upper is None:
+        # 走査範囲に変更がない場合（IDの欠番）は範囲の終端まで進める
+        upper = min(scan_upper, max_id) if first_recent_id is None else since
+    upper = max(upper, since)
+
+    # 物件ごとの最新の変更IDを取得（変更ログの有限なID範囲のみを走査）
+    latest_changes = db.query(
+        func.max(change_log.id).label("change_id")
+    ).filter(
+        change_log.id > since, change_log.id <= upper
+    ).group_by(
+        change_log.property_id
+    ).subquery()
+
+    changes = db.query(change_log).join(
+        latest_changes, change_log.id == latest_changes.c.change_id
+    ).order_by(change_log.id).limit(limit + 1).all()
+
+    if len(changes) > limit:
+        changes = changes[:limit]
+        next_token = changes[-1].id
+        has_more = True
+    else:
+        next_token = upper
+        has_more = first_recent_id is None and max_id > upper
+
+    # 削除以外の変更について現在の物件情報をまとめて取得
+    property_ids = [change.property_id for change in changes if change.operation != "DELETE"]
+    properties = {}
+    if property_ids:
+        properties = {
+            property.id: property
+            for property in db.query(models.Property).filter(models.Property.id.in_(property_ids))
+        }
+
+    return {
+        "changes": [
+            {
+                "change_id": change.id,
+                "property_id": change.property_id,
+                "operation": change.operation,
+                "changed_at": change.changed_at,
+                "property": properties.get(change.property_id),
+            }
+            for change in changes
+        ],
+        "next_token": next_token,
+        "has_more": has_more,
+    }
+
+
+@router.get("/properties/stream")
+async def stream_properties(
+    request: Request,
+    station: Optional[str] = None,
+    min_rent: Optional[int] = None,
+    max_rent: Optional[int] = None,
+    floor_plan: Optional[str] = None,
+):
+    """
+    新規登録・ステータス変更された物件をServer-Sent Eventsで配信するエンドポイント。
+    フィルタリング条件は物件一覧と同じものを指定可能。
+    受信が追いつかずイベントを破棄した場合はlaggedイベントを送信するため、
+    クライアントは/properties/changesで差分を再取得してください。
+    重複掲載と判定された物件は配信しません。元物件の削除により重複掲載が
+    元物件に昇格した場合も、同一住戸のため新着としては配信しません。
+    """
+    async def event_stream():
+        # レスポンスの送信が始まらなかった場合に購読が残らないよう、ジェネレータ内で購読する
+        subscription = broker.subscribe(
+            station=station,
+            min_rent=min_rent,
+            max_rent=max_rent,
+            floor_plan=floor_plan,
+        )
+        try:
+            while True:
+                if not await subscription.wait(STREAM_HEARTBEAT_SECONDS):
+                    if await request.is_disconnected():
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+
+                if subscription.dropped:
+                    yield f'event: lagged\ndata: {{"dropped": {subscription.dropped}}}\n\n'
+                    subscription.dropped = 0
+
+                for property_event in subscription.drain():
+                    yield f"event: {property_event.event}\ndata: {property_event.json()}\n\n"
+        finally:
+            broker.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.get("/properties/{property_id}", response_model=schemas.Property)
 def get_property(property_id: int, db: Session = Depends(get_db)):
     """
@@ -54,8 +233,10 @@ def get_property(property_id: int, db: Session = Depends(get_db)):
 def create_property(property: schemas.PropertyCreate, db: Session = Depends(get_db)):
     """
     新しい物件を作成するエンドポイント。
+    他サイトで掲載済みの同一物件と判定された場合はduplicate_of_idに元の物件IDを設定します。
     """
     db_property = models.Property(**property.dict())
+    link_duplicate(db, db_property)
     db.add(db_property)
     db.commit()
     db.refresh(db_property)
@@ -66,15 +247,19 @@ def create_property(property: schemas.PropertyCreate, db: Session = Depends(get_
 def update_property(property_id: int, property: schemas.PropertyUpdate, db: Session = Depends(get_db)):
     """
     指定されたIDの物件情報を更新するエンドポイント。
+    住所や家賃など重複判定に使う値が変わった場合は重複の紐付けをやり直します。
     """
     db_property = db.query(models.Property).filter(models.Property.id == property_id).first()
     if db_property is None:
         raise HTTPException(status_code=404, detail="Property not found")
     
+    previous_signature = dedup_signature(db_property)
+
     # 更新対象のプロパティを更新
     for key, value in property.dict().items():
         setattr(db_property, key, value)
     
+    relink_duplicate(db, db_property, previous_signature)
     db.commit()
     db.refresh(db_property)
     return db_property
@@ -89,6 +274,8 @@ def delete_property(property_id: int, db: Session = Depends(get_db)):
     if db_property is None:
         raise HTTPException(status_code=404, detail="Property not found")
     
+    # 重複掲載の紐付け先を付け替える
+    unlink_duplicates(db, db_property)
     db.delete(db_property)
     db.commit()
     return {"message": "Property deleted successfully"}
@@ -109,6 +109,10 @@ class Notification(NotificationBase):
 
 class Property(PropertyBase):
     id: int
+    # デフォルト重みでのおすすめスコア
+    score: Optional[float] = None
+    # 重複掲載の場合は元の物件のID
+    duplicate_of_id: Optional[int] = None
     created_at: datetime
     updated_at: datetime
     internet_provider: Optional[InternetProvider] = None
@@ -117,3 +121,28 @@ class Property(PropertyBase):
 
     class Config:
         orm_mode = True
+
+
+class PropertyChange(BaseModel):
+    change_id: int
+    property_id: int
+    operation: str
+    changed_at: datetime
+    # 削除（DELETE）の場合はNone
+    property: Optional[Property] = None
+
+
+class PropertyChangeFeed(BaseModel):
+    changes: List[PropertyChange] = []
+    next_token: int
+    has_more: bool
+
+
+class PropertyStreamItem(PropertyBase):
+    id: int
+
+
+class PropertyStreamEvent(BaseModel):
+    # CREATED または STATUS_CHANGED
+    event: str
+    property: PropertyStreamItem
@@ -0,0 +1,96 @@
+from typing import Dict, Optional
+
+from sqlalchemy import case, event, exists, func, inspect, or_, select, update
+
+from ..models import models
+
+# 築年数の基準年。スコアは物件同士の比較にのみ使うため固定値とし、
+# 年が変わっても保存済みのスコアを再計算せずに済むようにする
+SCORE_REFERENCE_YEAR = 2025
+
+# 駐輪場情報がない物件に用いる想定距離（km）
+DEFAULT_BIKE_PARKING_DISTANCE = 2.0
+
+# スコアの重み（スコアは高いほど条件が良い）
+DEFAULT_WEIGHTS: Dict[str, float] = {
+    "rent": 1.0,            # 家賃＋管理費 1万円あたりの減点
+    "walking_minutes": 0.5, # 駅徒歩 1分あたりの減点
+    "size_sqm": 0.2,        # 専有面積 1㎡あたりの加点
+    "building_age": 0.1,    # 築年数 1年あたりの減点
+    "corner_room": 1.0,     # 角部屋の加点
+    "internet_plan": 1.0,   # インターネット回線プランありの加点
+    "bike_parking": 2.0,    # 最寄り駐輪場までの距離 1kmあたりの減点
+}
+
+
+def score_expression(weights: Optional[Dict[str, float]] = None):
+    """
+    物件スコアを計算するSQL式を返す。
+    """
+    weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+    property = models.Property
+    return (
+        - weights["rent"] * (property.rent + func.coalesce(property.management_fee, 0)) / 10000.0
+        - weights["walking_minutes"] * property.walking_minutes
+        + weights["size_sqm"] * property.size_sqm
+        - weights["building_age"] * (SCORE_REFERENCE_YEAR - property.built_year)
+        + weights["corner_room"] * case((property.corner_room, 1), else_=0)
+        + weights["internet_plan"] * case((property.has_internet_plan, 1), else_=0)
+        - weights["bike_parking"] * func.coalesce(
+            property.nearest_bike_parking_distance, DEFAULT_BIKE_PARKING_DISTANCE
+        )
+    )
+
+
+def refresh_property_score(connection, property_id: Optional[int]):
+    """
+    指定物件のスコア計算用の集計値とデフォルト重みのスコアを再計算する。
+    変更ログへの記録は物件・関連テーブルの書き込み時にmodels側で行う。
+    """
+    if property_id is None:
+        return
+
+    provider = models.InternetProvider
+    parking = models.BikeParking
+    plans = [provider.flets_plan, provider.au_hikari_plan, provider.nuro_plan, provider.jcom_plan]
+    properties = models.Property.__table__
+
+    # updated_atは変更せずに集計値のみ更新する
+    connection.execute(
+        update(properties).where(properties.c.id == property_id).values(
+            has_internet_plan=exists().where(
+                provider.property_id == property_id,
+                or_(*[func.coalesce(plan, "") != "" for plan in plans]),
+            ),
+            nearest_bike_parking_distance=select(func.min(parking.distance)).where(
+                parking.property_id == property_id
+            ).scalar_subquery(),
+            updated_at=properties.c.updated_at,
+        )
+    )
+    connection.execute(
+        update(properties).where(properties.c.id == property_id).values(
+            score=score_expression(),
+            updated_at=properties.c.updated_at,
+        )
+    )
+
+
+# 物件・回線プラン・駐輪場の書き込み時にスコアを再計算する
+@event.listens_for(models.Property, "after_insert")
+@event.listens_for(models.Property, "after_update")
+def _property_after_write(mapper, connection, target):
+    refresh_property_score(connection, target.id)
+
+
+@event.listens_for(models.InternetProvider, "after_insert")
+@event.listens_for(models.InternetProvider, "after_update")
+@event.listens_for(models.InternetProvider, "after_delete")
+@event.listens_for(models.BikeParking, "after_insert")
+@event.listens_for(models.BikeParking, "after_update")
+@event.listens_for(models.BikeParking, "after_delete")
+def _related_after_write(mapper, connection, target):
+    # 紐付け先の物件が変わった場合は変更前の物件も再計算する
+    history = inspect(target).attrs.property_id.history
+    for property_id in set(history.deleted or []) | {target.property_id}:
+        refresh_property_score(connection, property_id)
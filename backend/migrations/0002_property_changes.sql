@@ -0,0 +1,14 @@
+-- 物件変更ログ（差分同期用）
+
+-- property_changes テーブル (物件の追加・更新・削除履歴)
+CREATE TABLE IF NOT EXISTS property_changes (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    property_id BIGINT NOT NULL,
+    operation VARCHAR(10) NOT NULL,
+    changed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_property_id (property_id)
+);
+
+-- 既存の物件を変更ログに登録（since=0からの初回同期で全件を取得できるようにする）
+INSERT INTO property_changes (property_id, operation)
+SELECT id, 'INSERT' FROM properties ORDER BY id;
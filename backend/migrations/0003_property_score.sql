@@ -0,0 +1,34 @@
+-- 物件のおすすめスコア（sort=score）
+
+-- properties テーブルにスコア計算用の集計値とスコアを追加
+ALTER TABLE properties
+    ADD COLUMN has_internet_plan TINYINT(1) NOT NULL DEFAULT 0,
+    ADD COLUMN nearest_bike_parking_distance FLOAT,
+    ADD COLUMN score FLOAT,
+    ADD INDEX idx_score (score);
+
+-- 既存データの集計値を計算
+UPDATE properties p
+SET
+    p.has_internet_plan = EXISTS (
+        SELECT 1 FROM internet_providers i
+        WHERE i.property_id = p.id
+          AND (COALESCE(i.flets_plan, '') != '' OR COALESCE(i.au_hikari_plan, '') != ''
+               OR COALESCE(i.nuro_plan, '') != '' OR COALESCE(i.jcom_plan, '') != '')
+    ),
+    p.nearest_bike_parking_distance = (
+        SELECT MIN(b.distance) FROM bike_parkings b WHERE b.property_id = p.id
+    ),
+    p.updated_at = p.updated_at;
+
+-- 既存データのスコアを計算（重みは app/scoring/property_score.py の DEFAULT_WEIGHTS と同じ）
+UPDATE properties
+SET
+    score = - 1.0 * (rent + COALESCE(management_fee, 0)) / 10000.0
+            - 0.5 * walking_minutes
+            + 0.2 * size_sqm
+            - 0.1 * (2025 - built_year)
+            + 1.0 * corner_room
+            + 1.0 * has_internet_plan
+            - 2.0 * COALESCE(nearest_bike_parking_distance, 2.0),
+    updated_at = updated_at;
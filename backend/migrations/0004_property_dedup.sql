@@ -0,0 +1,15 @@
+-- 物件の重複掲載検出
+
+-- properties テーブルにブロッキングキーと重複元の物件IDを追加
+ALTER TABLE properties
+    ADD COLUMN dedup_address_key VARCHAR(300),
+    ADD COLUMN dedup_geo_key VARCHAR(100),
+    ADD COLUMN duplicate_of_id BIGINT,
+    ADD INDEX idx_dedup_address_key (dedup_address_key),
+    ADD INDEX idx_dedup_geo_key (dedup_geo_key),
+    ADD INDEX idx_duplicate_of_id (duplicate_of_id),
+    ADD INDEX idx_duplicate_of_score (duplicate_of_id, score),
+    ADD FOREIGN KEY (duplicate_of_id) REFERENCES properties(id) ON DELETE SET NULL;
+
+-- 既存データのブロッキングキーと重複の紐付けは以下で計算する
+-- cd backend && python -m app.dedup.property_dedup
@@ -1,12 +1,21 @@
+import asyncio
+import json
+import os
+from urllib.parse import urlencode
+
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, insert, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
 from app.main import app
 from app.database.database import Base, get_db
 from app.models.models import Property, InternetProvider, BikeParking
+from app.pubsub.property_broker import broker, Subscription
+from app.schemas import schemas
+from app.dedup.property_dedup import backfill_duplicates, normalize_address
+from app.routes import property_routes
 
 # テスト用のインメモリSQLiteデータベースを設定
 SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
@@ -38,6 +47,11 @@ def test_db():
     # テスト後にテーブルをクリア
     Base.metadata.drop_all(bind=engine)
 
+@pytest.fixture(autouse=True)
+def no_change_feed_delay(monkeypatch):
+    # テストでは直近の変更も差分フィードに含める
+    monkeypatch.setattr(property_routes, "CHANGE_FEED_SAFETY_SECONDS", 0)
+
 @pytest.fixture
 def sample_property(test_db):
     # テスト用の物件データを作成
@@ -122,3 +136,437 @@ def test_get_bike_parkings(sample_property):
     assert len(response.json()) > 0
     assert response.json()[0]["parking_name"] == "テスト駐輪場"
     assert response.json()[0]["distance"] == 0.5
+
+def property_payload(**overrides):
+    payload = {
+        "name": "差分テスト物件",
+        "address": "東京都渋谷区2-2-2",
+        "station": "渋谷",
+        "walking_minutes": 8,
+        "rent": 90000,
+        "floor_plan": "1K",
+        "size_sqm": 25.0,
+        "building_structure": "RC",
+        "built_year": 2010,
+        "floor": 2,
+        "corner_room": False,
+        "status": "NEW",
+        "site_url": "https://example.com/property/2",
+    }
+    payload.update(overrides)
+    return payload
+
+def test_get_property_changes(test_db):
+    created = client.post("/properties/", json=property_payload()).json()
+    response = client.get("/properties/changes")
+    assert response.status_code == 200
+    feed = response.json()
+    assert [change["operation"] for change in feed["changes"]] == ["INSERT"]
+    assert feed["changes"][0]["property"]["name"] == "差分テスト物件"
+    assert feed["has_more"] is False
+
+    # トークン以降の変更のみが返される
+    token = feed["next_token"]
+    assert client.get(f"/properties/changes?since={token}").json()["changes"] == []
+
+    client.put(f"/properties/{created['id']}", json=property_payload(rent=85000))
+    feed = client.get(f"/properties/changes?since={token}").json()
+    assert [change["operation"] for change in feed["changes"]] == ["UPDATE"]
+    assert feed["changes"][0]["property"]["rent"] == 85000
+    assert feed["next_token"] > token
+
+def test_get_property_changes_seeded_by_migration(test_db):
+    # 変更ログ導入前から存在する物件を再現する（マッパーイベントを経由しない）
+    with engine.begin() as connection:
+        connection.execute(insert(Property.__table__), [
+            property_payload(name=f"既存物件{i}") for i in range(2)
+        ])
+
+        # マイグレーションの既存物件の登録処理を実行する
+        migration = os.path.join(os.path.dirname(__file__), "..", "migrations", "0002_property_changes.sql")
+        with open(migration, encoding="utf-8") as f:
+            statements = [statement.strip() for statement in f.read().split(";")]
+        seed = next(statement for statement in statements if "INSERT INTO property_changes" in statement)
+        connection.execute(text(seed))
+
+    feed = client.get("/properties/changes?since=0").json()
+    assert [change["operation"] for change in feed["changes"]] == ["INSERT", "INSERT"]
+    assert [change["property"]["name"] for change in feed["changes"]] == ["既存物件0", "既存物件1"]
+
+def test_get_property_changes_tombstone(test_db):
+    created = client.post("/properties/", json=property_payload()).json()
+    client.put(f"/properties/{created['id']}", json=property_payload(rent=85000))
+    client.delete(f"/properties/{created['id']}")
+
+    # 複数回の変更は最新の削除1件にまとめられる
+    feed = client.get("/properties/changes").json()
+    assert len(feed["changes"]) == 1
+    assert feed["changes"][0]["operation"] == "DELETE"
+    assert feed["changes"][0]["property_id"] == created["id"]
+    assert feed["changes"][0]["property"] is None
+
+def test_get_property_changes_tombstone_with_related(test_db):
+    created = client.post("/properties/", json=property_payload()).json()
+    client.post("/bike-parkings/", json={
+        "property_id": created["id"],
+        "parking_name": "テスト駐輪場",
+        "address": "東京都渋谷区2-2-3",
+        "parking_url": "https://example.com/parking/2",
+    })
+    client.post("/internet-providers/", json={
+        "property_id": created["id"],
+        "flets_plan": "フレッツ 光ネクスト マンションタイプ",
+        "checked_at": "2025-04-01T00:00:00",
+    })
+    client.post("/notifications/", json={
+        "property_id": created["id"],
+        "notified_at": "2025-04-01T00:00:00",
+    })
+
+    # 関連情報を持つ物件も削除でき、トゥームストーンが記録される
+    assert client.delete(f"/properties/{created['id']}").status_code == 200
+    feed = client.get("/properties/changes").json()
+    assert [(change["property_id"], change["operation"]) for change in feed["changes"]] == [(created["id"], "DELETE")]
+    assert client.get(f"/bike-parkings/property/{created['id']}").json() == []
+
+def test_get_property_changes_pagination(test_db):
+    for i in range(3):
+        client.post("/properties/", json=property_payload(name=f"物件{i}"))
+    feed = client.get("/properties/changes?limit=2").json()
+    assert len(feed["changes"]) == 2
+    assert feed["has_more"] is True
+    feed = client.get(f"/properties/changes?since={feed['next_token']}&limit=2").json()
+    assert [change["property"]["name"] for change in feed["changes"]] == ["物件2"]
+    assert feed["has_more"] is False
+
+def test_property_stream_events(test_db):
+    async def scenario():
+        subscription = broker.subscribe(station="渋谷")
+        try:
+            created = (await asyncio.to_thread(
+                client.post, "/properties/", json=property_payload()
+            )).json()
+            # フィルタに一致しない物件は配信されない
+            await asyncio.to_thread(
+                client.post, "/properties/", json=property_payload(station="新宿")
+            )
+            await asyncio.to_thread(
+                client.put, f"/properties/{created['id']}", json=property_payload(status="NOTIFIED")
+            )
+            # 家賃のみの更新は配信されない
+            await asyncio.to_thread(
+                client.put, f"/properties/{created['id']}", json=property_payload(status="NOTIFIED", rent=80000)
+            )
+            await asyncio.sleep(0)
+            return subscription.drain()
+        finally:
+            broker.unsubscribe(subscription)
+
+    events = asyncio.run(scenario())
+    assert [event.event for event in events] == ["CREATED", "STATUS_CHANGED"]
+    assert events[1].property.status == "NOTIFIED"
+
+def test_stream_properties_endpoint():
+    async def scenario():
+        request_sent = False
+        disconnected = asyncio.Event()
+        messages = asyncio.Queue()
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            await messages.put(message)
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/properties/stream",
+            "raw_path": b"/properties/stream",
+            "root_path": "",
+            "query_string": urlencode({"station": "渋谷"}).encode(),
+            "headers": [(b"host", b"testserver")],
+            "client": ("testclient", 50000),
+            "server": ("testserver", 80),
+        }
+        # ストリームは終了しないため、ASGIアプリを直接呼び出して切断を送る
+        task = asyncio.create_task(app(scope, receive, send))
+        start = await asyncio.wait_for(messages.get(), 5)
+        while broker.subscription_count() == 0:
+            await asyncio.sleep(0.01)
+
+        # バッファ上限を超える件数を一度に発行する
+        for i in range(105):
+            broker.publish(schemas.PropertyStreamEvent(
+                event="CREATED",
+                property=schemas.PropertyStreamItem(id=i, **property_payload()),
+            ))
+        broker.publish(schemas.PropertyStreamEvent(
+            event="CREATED",
+            property=schemas.PropertyStreamItem(id=999, **property_payload(station="新宿")),
+        ))
+
+        chunks = []
+        while len(chunks) < 101:
+            message = await asyncio.wait_for(messages.get(), 5)
+            if message["body"]:
+                chunks.append(message["body"].decode())
+
+        disconnected.set()
+        await asyncio.wait_for(task, 5)
+        return start, chunks, broker.subscription_count()
+
+    start, chunks, remaining = asyncio.run(scenario())
+    assert start["status"] == 200
+    assert (b"content-type", b"text/event-stream; charset=utf-8") in start["headers"]
+    # 溢れた分はlaggedイベントで通知される
+    assert chunks[0] == 'event: lagged\ndata: {"dropped": 5}\n\n'
+    event_lines = chunks[1].strip().split("\n")
+    assert event_lines[0] == "event: CREATED"
+    assert event_lines[1].startswith("data: ")
+    assert json.loads(event_lines[1][len("data: "):])["property"]["id"] == 5
+    assert [json.loads(chunk.split("data: ", 1)[1])["property"]["id"] for chunk in chunks[1:]] == list(range(5, 105))
+    # 切断後は購読が解除される
+    assert remaining == 0
+
+def test_stream_properties_not_iterated():
+    # レスポンスの送信が始まらなければ購読は作られない
+    asyncio.run(property_routes.stream_properties(request=None))
+    assert broker.subscription_count() == 0
+
+def test_property_stream_bounded_buffer():
+    async def scenario():
+        subscription = Subscription(asyncio.get_running_loop(), buffer_size=2)
+        for i in range(5):
+            subscription.push(schemas.PropertyStreamEvent(
+                event="CREATED",
+                property=schemas.PropertyStreamItem(id=i, **property_payload()),
+            ))
+        return subscription
+
+    subscription = asyncio.run(scenario())
+    assert subscription.dropped == 3
+    assert [event.property.id for event in subscription.drain()] == [3, 4]
+
+def test_get_properties_sort_by_score(test_db):
+    cheap = client.post("/properties/", json=property_payload(name="安い物件", rent=60000)).json()
+    large = client.post("/properties/", json=property_payload(name="広い物件", rent=120000, size_sqm=40.0)).json()
+    assert cheap["score"] > large["score"]
+
+    response = client.get("/properties/?sort=score")
+    assert response.status_code == 200
+    assert [p["name"] for p in response.json()] == ["安い物件", "広い物件"]
+
+    # 重みを変更すると順位が変わる
+    response = client.get("/properties/?sort=score&w_size_sqm=1.0")
+    assert [p["name"] for p in response.json()] == ["広い物件", "安い物件"]
+
+    assert client.get("/properties/?sort=unknown").status_code == 400
+
+def test_get_properties_sort_by_score_uses_index(test_db):
+    # 重複掲載を除いたおすすめ順の上位取得が全件の並べ替えにならないこと
+    db = TestingSessionLocal()
+    query = db.query(Property).filter(Property.duplicate_of_id.is_(None)).order_by(
+        Property.score.desc(), Property.id.desc()
+    ).limit(10)
+    statement = str(query.statement.compile(engine, compile_kwargs={"literal_binds": True}))
+    plan = " ".join(row[3] for row in db.execute(text(f"EXPLAIN QUERY PLAN {statement}")))
+    db.close()
+    assert "idx_duplicate_of_score" in plan
+    assert "TEMP B-TREE" not in plan
+
+def test_property_score_follows_bike_parking(test_db):
+    created = client.post("/properties/", json=property_payload()).json()
+    token = client.get("/properties/changes").json()["next_token"]
+    response = client.post("/bike-parkings/", json={
+        "property_id": created["id"],
+        "parking_name": "近い駐輪場",
+        "address": "東京都渋谷区2-2-3",
+        "distance": 0.1,
+        "parking_url": "https://example.com/parking/2",
+    })
+    assert response.status_code == 200
+
+    # 最寄り駐輪場が近くなった分スコアが上がる（想定距離2km → 0.1km）
+    updated = client.get(f"/properties/{created['id']}").json()
+    assert updated["score"] == pytest.approx(created["score"] + 2.0 * (2.0 - 0.1))
+    assert updated["updated_at"] == created["updated_at"]
+
+    # スコアの変更は差分フィードに記録される
+    feed = client.get(f"/properties/changes?since={token}").json()
+    assert [change["operation"] for change in feed["changes"]] == ["UPDATE"]
+    assert feed["changes"][0]["property"]["score"] == pytest.approx(updated["score"])
+
+def test_normalize_address():
+    assert normalize_address("東京都新宿区西新宿 １丁目２番３号") == "東京都新宿区西新宿1-2-3"
+    assert normalize_address("東京都新宿区西新宿1ー2−3") == "東京都新宿区西新宿1-2-3"
+    assert normalize_address("東京都渋谷区道玄坂一丁目十二番二十三号") == "東京都渋谷区道玄坂1-12-23"
+    # 丁目・番・号の前以外の漢数字は変換しない
+    assert normalize_address("東京都世田谷区三軒茶屋二丁目1") == "東京都世田谷区三軒茶屋2-1"
+
+def test_create_property_links_duplicate_across_rent_bucket(test_db):
+    original = client.post("/properties/", json=property_payload(
+        address="渋谷区道玄坂1-1-1", latitude=35.6580, longitude=139.7010, rent=99500,
+    )).json()
+    # 家賃の区切りの境界をまたいでも許容差内なら重複と判定される
+    duplicate = client.post("/properties/", json=property_payload(
+        address="東京都渋谷区道玄坂一丁目1番1号", latitude=35.6580, longitude=139.7010, rent=100500,
+    )).json()
+    assert duplicate["duplicate_of_id"] == original["id"]
+
+def test_create_property_links_duplicate(test_db):
+    original = client.post("/properties/", json=property_payload(
+        address="東京都渋谷区2丁目2番2号", latitude=35.6580, longitude=139.7010,
+    )).json()
+    # 別サイトから表記揺れのある住所・管理費込みで同額の家賃で掲載
+    duplicate = client.post("/properties/", json=property_payload(
+        address="東京都渋谷区２－２－２",
+        rent=85000,
+        management_fee=5000,
+        site_url="https://example.org/listing/2",
+    )).json()
+    other_floor = client.post("/properties/", json=property_payload(floor=3)).json()
+    # 近隣の別の建物は座標が近くても重複としない
+    neighbor = client.post("/properties/", json=property_payload(
+        name="別の建物B", address="東京都渋谷区9-9-9", latitude=35.6583, longitude=139.7013,
+    )).json()
+
+    assert original["duplicate_of_id"] is None
+    assert duplicate["duplicate_of_id"] == original["id"]
+    assert other_floor["duplicate_of_id"] is None
+    assert neighbor["duplicate_of_id"] is None
+
+    ids = [p["id"] for p in client.get("/properties/").json()]
+    assert ids == [original["id"], other_floor["id"], neighbor["id"]]
+    assert len(client.get("/properties/?include_duplicates=true").json()) == 4
+
+    # 元の物件を削除すると重複物件が昇格する
+    client.delete(f"/properties/{original['id']}")
+    assert client.get(f"/properties/{duplicate['id']}").json()["duplicate_of_id"] is None
+
+def test_update_property_relinks_duplicate(test_db):
+    original = client.post("/properties/", json=property_payload()).json()
+    duplicate = client.post("/properties/", json=property_payload(site_url="https://example.org/listing/2")).json()
+    assert duplicate["duplicate_of_id"] == original["id"]
+
+    # 重複判定に関係しない値の更新では紐付けを維持する
+    updated = client.put(f"/properties/{duplicate['id']}", json=property_payload(
+        site_url="https://example.org/listing/2", status="NOTIFIED",
+    )).json()
+    assert updated["duplicate_of_id"] == original["id"]
+
+    # 別の住戸に更新されると紐付けが解除され一覧に表示される
+    updated = client.put(f"/properties/{duplicate['id']}", json=property_payload(
+        address="東京都渋谷区5-5-5", floor=7, site_url="https://example.org/listing/2",
+    )).json()
+    assert updated["duplicate_of_id"] is None
+    assert duplicate["id"] in [p["id"] for p in client.get("/properties/").json()]
+
+    # 再び同一住戸に戻ると重複として紐付けられる
+    updated = client.put(f"/properties/{duplicate['id']}", json=property_payload(
+        address="東京都渋谷区2丁目2番2号", site_url="https://example.org/listing/2",
+    )).json()
+    assert updated["duplicate_of_id"] == original["id"]
+
+def test_backfill_duplicates(test_db):
+    db = TestingSessionLocal()
+    for i, address in enumerate(["東京都渋谷区2-2-2", "東京都渋谷区２丁目２番２号", "東京都渋谷区3-3-3"]):
+        db.add(Property(**property_payload(address=address, latitude=35.658, longitude=139.701, name=f"物件{i}")))
+    # 住所表記が異なっても建物名が同じで座標・家賃・面積が近ければ重複と判定される
+    db.add(Property(**property_payload(address="渋谷区道玄坂", latitude=35.6581, longitude=139.7012, rent=91000, name="物件0")))
+    db.commit()
+    # ブロッキングキー未設定の状態を再現する
+    db.query(Property).update({Property.dedup_address_key: None, Property.dedup_geo_key: None})
+    db.commit()
+    token = client.get("/properties/changes").json()["next_token"]
+
+    assert backfill_duplicates(db) == 2
+    duplicates = db.query(Property).filter(Property.duplicate_of_id.isnot(None)).all()
+    assert {p.id for p in duplicates} == {2, 4}
+    assert {p.duplicate_of_id for p in duplicates} == {1}
+    # 同じ座標ブロックでも住所・建物名が異なる物件は重複としない
+    assert db.query(Property).filter(Property.id == 3).one().duplicate_of_id is None
+
+    # 紐付けが変わった物件のみ差分フィードに記録される（ブロッキングキーのみの変更は記録しない）
+    feed = client.get(f"/properties/changes?since={token}").json()
+    assert sorted(change["property_id"] for change in feed["changes"]) == [2, 4]
+    assert {change["operation"] for change in feed["changes"]} == {"UPDATE"}
+
+    # 変更がない場合は何も記録しない
+    token = feed["next_token"]
+    assert backfill_duplicates(db) == 2
+    assert client.get(f"/properties/changes?since={token}").json()["changes"] == []
+    db.close()
+
+def test_property_stream_skips_duplicates(test_db):
+    async def scenario():
+        subscription = broker.subscribe()
+        try:
+            original = (await asyncio.to_thread(
+                client.post, "/properties/", json=property_payload()
+            )).json()
+            duplicate = (await asyncio.to_thread(
+                client.post, "/properties/", json=property_payload(site_url="https://example.org/listing/2")
+            )).json()
+            # 重複掲載のステータス変更は配信しない
+            await asyncio.to_thread(
+                client.put, f"/properties/{duplicate['id']}", json=property_payload(status="NOTIFIED")
+            )
+            # 元物件の削除による昇格も新着として配信しない
+            await asyncio.to_thread(client.delete, f"/properties/{original['id']}")
+            await asyncio.sleep(0)
+            return original, subscription.drain()
+        finally:
+            broker.unsubscribe(subscription)
+
+    original, events = asyncio.run(scenario())
+    assert [(event.event, event.property.id) for event in events] == [("CREATED", original["id"])]
+
+def test_get_property_changes_nested(test_db):
+    created = client.post("/properties/", json=property_payload()).json()
+    parking = {
+        "property_id": created["id"],
+        "parking_name": "テスト駐輪場",
+        "address": "東京都渋谷区2-2-3",
+        "distance": 0.3,
+        "fee": "月額2000円",
+        "parking_url": "https://example.com/parking/2",
+    }
+    parking_id = client.post("/bike-parkings/", json=parking).json()["id"]
+    token = client.get("/properties/changes").json()["next_token"]
+
+    # スコアに影響しない関連情報の変更も記録される
+    client.put(f"/bike-parkings/{parking_id}", json={**parking, "fee": "月額3000円"})
+    feed = client.get(f"/properties/changes?since={token}").json()
+    assert [change["operation"] for change in feed["changes"]] == ["UPDATE"]
+    assert feed["changes"][0]["property"]["bike_parkings"][0]["fee"] == "月額3000円"
+
+def test_get_property_changes_holds_recent_changes(test_db, monkeypatch):
+    monkeypatch.setattr(property_routes, "CHANGE_FEED_SAFETY_SECONDS", 60)
+    client.post("/properties/", json=property_payload())
+
+    # 直近の変更は未コミットの変更を追い越している可能性があるため返さない
+    feed = client.get("/properties/changes").json()
+    assert feed == {"changes": [], "next_token": 0, "has_more": False}
+
+def test_get_property_changes_scan_window(test_db, monkeypatch):
+    monkeypatch.setattr(property_routes, "CHANGE_FEED_SCAN_WINDOW", 2)
+    for i in range(3):
+        client.post("/properties/", json=property_payload(name=f"物件{i}"))
+
+    # 1回のリクエストで走査するID範囲は制限される
+    feed = client.get("/properties/changes").json()
+    assert [change["property"]["name"] for change in feed["changes"]] == ["物件0", "物件1"]
+    assert feed["next_token"] == 2
+    assert feed["has_more"] is True
+    feed = client.get(f"/properties/changes?since={feed['next_token']}").json()
+    assert [change["property"]["name"] for change in feed["changes"]] == ["物件2"]
+    assert feed["has_more"] is False